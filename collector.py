@@ -4,18 +4,31 @@
 # Additional details will be available in README.md
 # Licensed under GPLv3, see license.txt
 
+import atexit
 import bisect
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import gzip
 import html.parser
+import io
 import json
 import logging
 import logging.config
 import logging.handlers
+import mmap
 import os
 from pathlib import Path
+import random
 import requests
+from requests.adapters import HTTPAdapter
+import signal
+import struct
 import subprocess
+import sys
+import threading
 import time
+from urllib3.util.retry import Retry
 
 try:
     from prometheus_client import start_http_server, Gauge, Counter, Enum, Info, Summary
@@ -60,9 +73,38 @@ except ModuleNotFoundError:
         def observe(*args):
             pass
 
+# ISA-L is a drop-in replacement for zlib's gzip decompression, and several times faster.
+try:
+    from isal.igzip import IGzipFile as GzipFile
+except ModuleNotFoundError:
+    GzipFile = gzip.GzipFile
+
+# orjson encodes and decodes JSON several times faster than the json module.
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ModuleNotFoundError:
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+    json_loads = json.loads
+
+# selectolax parses HTML in C, which beats the callback based html.parser by a wide margin.
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+
 # Set some constants. Or well, "constants", but anyway.
 INDEX_NONE=0
 INDEX_AUTO=1
+# Read buffer for streamed files. GzipFile's default reads are small enough that per-call overhead dominates
+# when iterating lines; 128 KiB gives zlib a decently sized chunk to work on, larger gains very little.
+READ_BUFFER_SIZE=128*1024
+# Chunk size for downloads written straight to disk, which may be up to max_file_size each.
+WRITE_CHUNK_SIZE=64*1024
+# Max number of adjacent index clusters fetched with a single range request. Each is roughly 3000 lines, or ~200 KiB.
+MAX_CLUSTERS_PER_REQUEST=16
 
 # I don't like the configuration file alternatives python offers. I'll write my own.
 class Config:
@@ -74,7 +116,11 @@ class Config:
                               # Only applies to [W]ARC files.
     min_request_interval = 1.0
     max_request_interval = 60.0
+    max_requests_limit = 4 # Max number of concurrent downloads,
+                           # and max number of requests sent per max_requests_time seconds.
+    max_requests_time = 4.0
     cache_index_clusters = False
+    cluster_index_cache_size = 8 # Number of cluster indexes kept loaded.
     download_dir = None
     domain_list_file = Path('domains.conf')
     safe_path = Path.cwd()
@@ -90,19 +136,19 @@ class Config:
             with configFile.open('r') as f:
                 for line in f.read().splitlines():
                     # This isn't pretty, but it will ensure the preferred format is viable.
-                    key,value = line.split('=')
+                    key,_,value = line.partition('=') # Values may contain = as well.
                     if key == 'cache_index_clusters':
                         if value.lower() == 'true': value = True
                         elif value.lower() == 'false': value = False
                         else: raise TypeError('Key %s expects boolean value, got %s' % (key, value))
-                    elif key == 'min_request_interval':
-                        if value.isdecimal(): value = float(value)
-                        else: raise TypeError('Key %s expects float value, got %s' % (key, value))
+                    elif key in ['min_request_interval', 'max_request_interval', 'max_requests_time']:
+                        try: value = float(value) # isdecimal() would reject the decimal point.
+                        except ValueError: raise TypeError('Key %s expects float value, got %s' % (key, value))
                     elif key == 'indexing_method':
                         if value.lower() in ['download', 'none']: value = INDEX_NONE
                         elif value.lower() == 'auto': value = INDEX_AUTO
                         else: raise ValueError('Unknown indexing method: %s' % value)
-                    elif key in ['max_file_size', 'prometheus_port']:
+                    elif key in ['max_file_size', 'prometheus_port', 'max_requests_limit', 'cluster_index_cache_size']:
                         if value.isnumeric(): value = int(value)
                         else: raise TypeError('Key %s expects integer value, got %s' % (key, value))
                     elif key in ['domain_list_file', 'safe_path', 'cache_dir', 'tempdir', 'download_dir']:
@@ -126,6 +172,18 @@ else:
     mailer.addHandler(logging.handlers.SMTPHandler('localhost', config.mail_from_address, [config.notification_email], 'Collector Status Update'))
 mailer.propagate = False
 
+# Shared HTTP session, so connections to the archive host are kept alive and reused
+# instead of doing a new TCP and TLS handshake for every single request.
+session = requests.Session()
+# We handle gzip ourselves. A transfer encoded response would break both byte ranges and the Content-Length cache check.
+session.headers['Accept-Encoding'] = 'identity'
+# Room for plenty of kept-alive connections, and at least one per download thread plus one for the main thread, should
+# max_requests_limit be set above that. With fewer, urllib3 discards connections once the pool is full, and we're back
+# to a new handshake per request.
+# Only failed connections are retried here. Bad responses are backed off from in RemoteFile.get(), which also keeps
+# them within the request limits; urllib3 retrying them itself would hit the server harder just as it asks us to slow down.
+session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=max(64, config.max_requests_limit + 1), max_retries=Retry(total=3, connect=3, read=0, status=0, status_forcelist=[], backoff_factor=0.3)))
+
 # Exceptions
 class ParserError(Exception):
     pass
@@ -144,17 +202,15 @@ def human_readable(b):
     return '%.1f PiB' % b # Fallback. If we get this: worry.
 
 def path_is_safe(path, inst=None): # path is a Path.
+    p = str(path)
     if (
-            '/../' in str(path)
-         or str(path).startswith('../')
-         or str(path) == '..'
-         or str(path).endswith('/..')
+            '/../' in p
+         or p.startswith('../')
+         or p == '..'
+         or p.endswith('/..')
          or path.is_absolute()
-            and not (
-                str(path).startswith(str(config.download_dir))
-             or str(path).startswith(str(config.safe_path))
-             or str(path).startswith(str(config.cache_dir))
-             or str(path).startswith(str(config.tempdir))
+            and not any( # Compared by path component, so that /tmp/cccollector2 is not taken to be in /tmp/cccollector.
+                path.is_relative_to(root) for root in (config.download_dir, config.safe_path, config.cache_dir, config.tempdir) if root
     )):
         msg = 'Unsafe path: %s' % path
         if inst and type(inst) == RemoteFile: # Type is either RemoteFile or Domain. Only RemoteFile has attributes we want to add.
@@ -165,13 +221,30 @@ def path_is_safe(path, inst=None): # path is a Path.
         return False # Won't do anything, but if we remove the raise, this will need to be here.
     return True
 
+def stat_or_none(path):
+    # Saves a syscall over exists() followed by stat().
+    try:
+        return path.stat()
+    except FileNotFoundError:
+        return None
+
 def is_match(entry, search):
-    return entry.startswith(search + ')') or entry.startswith(search + ',')
+    return entry.startswith((search + ')', search + ','))
 
 def get_domain(domain):
-    for d in Domain.domains:
-        if d.domain == domain:
-            return d
+    return Domain.domains.get(domain)
+
+@functools.lru_cache(maxsize=None)
+def get_download_pool():
+    # Shared by searches and the retry queue, so max_requests_limit bounds all parallel downloads.
+    return ThreadPoolExecutor(max_workers=config.max_requests_limit)
+
+@functools.lru_cache(maxsize=config.cluster_index_cache_size)
+def get_cluster_index(archive):
+    # Every domain is searched against the same cluster index, so only load it once per archive.
+    if not archive.clusterIndex: # Implies indexPathsURI is also empty
+        archive.updatePaths()
+    return ClusterIndex(archive.clusterIndex)
 
 # Classes
 class Monitor:
@@ -232,7 +305,7 @@ class FileList: # UnkwnonStatusFileList would be a bit of a mouthful.
                     if len(self.files) == 0:
                         break
                     _,_,info = line.split(' ', 2)
-                    filename = json.loads(info)['filename']
+                    filename = json_loads(info)['filename']
                     position = bisect.bisect_left(self.files, filename)
                     if position < len(self.files) and self.files[position] == filename:
                         self.files.pop(position)
@@ -244,6 +317,8 @@ class FileList: # UnkwnonStatusFileList would be a bit of a mouthful.
                 logger.info('All files checked were properly indexed.')
 
 class Archive:
+    __slots__ = ('archiveID', 'indexPathsFile', 'clusterIndex', 'indexPathsURI', 'order')
+
     def __init__(self, archiveID, indexPathsFile):
         self.archiveID = archiveID
         self.indexPathsFile = RemoteFile(config.archive_host + indexPathsFile)
@@ -255,9 +330,7 @@ class Archive:
 
     def updatePaths(self):
         logger.debug('Updating paths for %s.', self.archiveID)
-        f = RemoteFile(self.indexPathsFile)
-        contents = f.read()
-        for line in contents.splitlines():
+        for line in self.indexPathsFile.iter_lines():
             if line.endswith('cluster.idx'):
                 self.clusterIndex = RemoteFile(config.archive_host + '/' + line, str(config.cache_dir) + '/' + self.archiveID + '/cluster.idx')
                 self.clusterIndex.bypass_decompression = True # Special case, 1 out of 2 files without compression.
@@ -267,10 +340,119 @@ class Archive:
             logger.critical('Could not update paths for archive %s (incomplete or otherwise malformed paths file).', self.archiveID)
             raise ParserError('Could not update paths for archive %s (incomplete or otherwise malformed paths file).', self.archiveID)
 
+class ClusterIndex:
+    # cluster.idx can have millions of lines, and is searched once per domain. Parse it once, then keep it in a
+    # packed binary file next to the cached cluster.idx, which is memory mapped and searched in place:
+    #   header: magic, version, entry count, key pool length, filename list length
+    #   entries: key offset, key length, timestamp, filename id, offset, length, cluster (fixed width)
+    #   key pool: all searchable strings back to back
+    #   filename list: the few hundred distinct index filenames, newline separated
+    magic = b'CCIDXMM\0'
+    version = 2
+    header = struct.Struct('<8sIIII')
+    entry = struct.Struct('<IHqHqiI') # There are only a few hundred index files, so their ids fit in 16 bits.
+
+    class Keys: # Sequence view of the searchable strings, so we can bisect them.
+        def __init__(self, index):
+            self.index = index
+
+        def __len__(self):
+            return len(self.index)
+
+        def __getitem__(self, i):
+            return self.index.key(i)
+
+    def __init__(self, remotefile):
+        packed = Path(str(remotefile.filename) + '.mmap') if remotefile.filename else None
+        packed_stat = stat_or_none(packed) if packed else None
+        self.data = None
+        if packed_stat and remotefile.cached() and packed_stat.st_mtime >= remotefile.filename.stat().st_mtime:
+            self.load(packed)
+        if self.data == None: # Not packed yet, outdated, or packed in an older format.
+            self.data = self.parse(remotefile)
+            if packed:
+                self.save(packed)
+                self.load(packed)
+            else:
+                self.unpack_header()
+        self.keys = ClusterIndex.Keys(self)
+
+    def __len__(self):
+        return self.count
+
+    def position(self, i): # Like a list, negative indexes count from the end.
+        position = i + self.count if i < 0 else i
+        if position < 0 or position >= self.count: # Past the entries, the data is something else entirely.
+            raise IndexError('Cluster index entry out of range: %d' % i)
+        return position
+
+    def __getitem__(self, i):
+        # Same layout as a line in the cluster index.
+        i = self.position(i)
+        key_offset,key_length,timestamp,filename,offset,length,cluster = self.entry.unpack_from(self.data, self.header.size + i*self.entry.size)
+        start = self.pool_start + key_offset
+        return (self.data[start:start+key_length].decode(), timestamp, self.filenames[filename], offset, length, cluster)
+
+    def key(self, i):
+        i = self.position(i)
+        key_offset,key_length = self.entry.unpack_from(self.data, self.header.size + i*self.entry.size)[0:2]
+        start = self.pool_start + key_offset
+        return self.data[start:start+key_length].decode()
+
+    def bisect(self, key):
+        return bisect.bisect_left(self.keys, key)
+
+    def find(self, key):
+        # The last entry at or before key, which is the cluster key would be found in.
+        i = bisect.bisect_right(self.keys, key) - 1
+        return self[i] if i >= 0 else None
+
+    def parse(self, remotefile):
+        entries = bytearray()
+        pool = bytearray()
+        filenames = {}
+        count = 0
+        # Work on bytes throughout, the keys would only be encoded again for the key pool. int() takes bytes as well.
+        for line in remotefile.iter_lines(decode=False):
+            key,rest = line.split(b' ')
+            timestamp,filename,offset,length,cluster = rest.split(b'\t')
+            entries += self.entry.pack(len(pool), len(key), int(timestamp), filenames.setdefault(filename, len(filenames)), int(offset), int(length), int(cluster))
+            pool += key
+            count += 1
+        filenames = b'\n'.join(filenames)
+        # Joined in one go, chained + would copy the entries and pool once more for every part added.
+        return b''.join((self.header.pack(self.magic, self.version, count, len(pool), len(filenames)), entries, pool, filenames))
+
+    def unpack_header(self):
+        magic,version,self.count,pool_length,filenames_length = self.header.unpack_from(self.data)
+        if magic != self.magic or version != self.version:
+            raise ParserError('Unknown packed cluster index format.')
+        self.pool_start = self.header.size + self.count*self.entry.size
+        filenames_start = self.pool_start + pool_length
+        self.filenames = bytes(self.data[filenames_start:filenames_start+filenames_length]).decode().split('\n')
+
+    def save(self, path):
+        # Write to a temporary file first, so a packed index is never seen half written.
+        temp = Path(str(path) + '.tmp')
+        with temp.open('wb') as f:
+            f.write(self.data)
+        temp.rename(path)
+
+    def load(self, path):
+        with path.open('rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic,version = self.header.unpack_from(data)[0:2]
+        if magic != self.magic or version != self.version:
+            logger.info('Packed cluster index %s is in an older format, rebuilding.', path)
+            data.close()
+            return
+        self.data = data
+        self.unpack_header()
+
 class ArchiveList:
     def __init__(self):
         self.archives = {}
-        self.lastUpdate = 0
+        self.lastUpdate = None # Monotonic time, so clock adjustments can't skip or repeat updates.
 
     def __iter__(self):
         return iter(self.archives.items())
@@ -312,19 +494,62 @@ class ArchiveList:
                 # There will be a second trigger with a newline, for unknown reason. This is why we need this handling.
                 self.archiveID = data
 
+    def parse(self, contents):
+        if SelectolaxParser:
+            archives = []
+            for row in SelectolaxParser(contents).css('tbody tr'):
+                cells = row.css('td')
+                link = cells[3].css_first('a[href]') if len(cells) >= 4 else None
+                if link:
+                    archives.append(Archive(cells[0].text(strip=True), link.attributes['href']))
+            return archives
+        parser = self.HTMLParser()
+        parser.feed(contents)
+        parser.close()
+        return parser.archives
+
     def update(self):
         initial = False
         if len(self.archives) == 0:
             initial = True
-        if time.time() - self.lastUpdate < 86400:
+        if self.lastUpdate != None and time.monotonic() - self.lastUpdate < 86400:
             return
         logger.debug('Updating archive list.')
-        index = RemoteFile(config.archive_host + config.archive_list_uri)
-        index.bypass_decompression = True # Hack for this one special case (and one more)
-        contents = index.read()
-        parser = self.HTMLParser()
-        parser.feed(contents)
-        if len(parser.archives) == 0:
+        # The list only changes about once a month. Keep a copy, and only have it sent if it has been modified.
+        index = RemoteFile(config.archive_host + config.archive_list_uri, Path(config.cache_dir, 'collections.html'))
+        meta = Path(config.cache_dir, 'collections.meta.json') # Its mtime is when the list was last checked.
+        meta_stat = stat_or_none(meta) if index.filename.exists() else None
+        lastChecked = time.monotonic()
+        if initial and meta_stat and time.time() - meta_stat.st_mtime < 86400:
+            # We have been restarted since the last check, the cached list will do until a day has passed since then.
+            logger.debug('Using cached archive list.')
+            lastChecked -= time.time() - meta_stat.st_mtime
+            contents = index.filename.read_bytes().decode() # As from the network, not in the locale's encoding.
+        else:
+            headers = {}
+            if meta_stat:
+                with meta.open('r') as f:
+                    cache = json.load(f)
+                if cache['etag']: headers['If-None-Match'] = cache['etag']
+                if cache['last_modified']: headers['If-Modified-Since'] = cache['last_modified']
+            r = index.get(headers, stream=True)
+            if r.status_code == 304:
+                r.close()
+                meta.touch()
+                if not initial:
+                    logger.debug('Archive list not modified.')
+                    self.lastUpdate = lastChecked
+                    return
+                contents = index.filename.read_bytes().decode()
+            else:
+                index.write(r.content)
+                temp = Path(str(meta) + '.tmp') # A truncated meta file would break every later update.
+                with temp.open('w') as f:
+                    json.dump({'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}, f)
+                os.replace(temp, meta)
+                contents = r.content.decode()
+        archives = self.parse(contents)
+        if len(archives) == 0:
             logger.critical('Could not parse archive list.')
             raise ParserError('Could not parse archive list.')
         preArchiveCount = 0
@@ -332,7 +557,7 @@ class ArchiveList:
             with Path('archive_count').open('r') as f:
                 preArchiveCount = int(f.read())
 
-        for archive in parser.archives:
+        for archive in archives:
             if archive.archiveID not in self.archives:
                 if not initial:
                     Monitor.get('monitor').UpdateStatus(latest_archive=archive.archiveID)
@@ -340,7 +565,7 @@ class ArchiveList:
                     mailer.info('New archive: %s' % archive.archiveID)
                 elif len(self.archives) == 0:
                     Monitor.get('monitor').UpdateStatus(latest_archive=archive.archiveID)
-                    if len(parser.archives) > preArchiveCount:
+                    if len(archives) > preArchiveCount:
                         mailer.info('New archive: %s' % archive.archiveID)
                 self.archives[archive.archiveID] = archive
                 self.archives[archive.archiveID].order = len(self.archives)
@@ -348,16 +573,21 @@ class ArchiveList:
                     with Path('archive_count').open('w') as f:
                         f.write(str(len(self.archives)))
 
-        parser.close()
-        self.lastUpdate = time.time()
+        self.lastUpdate = lastChecked
         if initial:
             logger.info('Found %d archives.', len(self.archives))
 
 class RemoteFile:
+    # There will be a lot of these, between search results and the retry queue, so skip the per instance dict.
+    __slots__ = ('url', 'filename', 'offset', 'length', 'attempts', 'bypass_decompression', 'domain', 'archiveID')
     requests = { # Using a dict for reference retention.
-        'last': 0,
+        'last': float('-inf'), # Monotonic time.
         'failed': 0,
+        'resume': float('-inf'), # Monotonic time, no requests are sent before this while backing off.
     }
+    lock = threading.Lock() # Downloads may run in parallel, guards the request interval.
+    request_times = collections.deque() # Monotonic timestamps of requests sent during the last max_requests_time seconds.
+    monitor = Monitor.get('monitor') # Looked up once here, rather than for every request from every download thread.
 
     def __init__(self, url, filename=None, offset=None, length=None, domain=None, archiveID=None):
         self.url = url
@@ -379,148 +609,266 @@ class RemoteFile:
     def download(self):
         #logger.debug('Downloading from %s to %s', self.url, str(self.filename))
         # Essentially just a wrapper, but it simplifies things.
+        # Returns False if the file was added to the retry queue.
         if not self.filename:
             logger.error('Attempted to download file with no local filename set: %s', self.url)
-        elif self.filename.exists():
-            if self.length and self.filename.stat().st_size < self.length:
+            return
+        self.filename.parents[0].mkdir(parents=True, exist_ok=True)
+        try:
+            f = self.filename.open('xb') # Exclusive create, so we don't need to check whether it exists first.
+        except FileExistsError:
+            st = self.filename.stat()
+            if self.length and st.st_size < self.length:
                 logger.info('Restarting incomplete download from %s to %s', self.url, self.filename)
+                f = self.filename.open('wb')
             else:
                 logger.warning('Attempted to download already existing file:')
                 logger.warning('  Filename: %s', self.filename)
                 logger.warning('  URL: %s', self.url)
-                logger.warning('  Size (local): %d bytes', self.filename.stat().st_size)
+                logger.warning('  Size (local): %d bytes', st.st_size)
                 logger.warning('  Size (remote): %d bytes', self.length)
                 return
         try:
-            contents = self.get()
+            with f, self.get(stream=True) as r:
+                for chunk in r.iter_content(WRITE_CHUNK_SIZE):
+                    f.write(chunk)
+                self.monitor.download_size.observe(f.tell())
         except (requests.RequestException, BadHTTPStatus) as error:
+            self.filename.unlink() # It will be downloaded from scratch again when retried.
             rq = RetryQueue()
             rq.add(self)
+            return False
         else:
-            self.write(contents)
             self.filename.rename(Path(config.download_dir, self.filename.name))
             FileList.get('unknown_status_files').add(self.filename.name)
 
-    def read(self):
-        #logger.debug('Reading from %s', self.url)
-        contents = None
-        if self.filename and self.filename.exists(): # File is in cache.
-            if self.length:
-                size = self.length
-            else:
-                r = requests.head(self.url)
+    def cached(self):
+        st = stat_or_none(self.filename) if self.filename else None
+        if not st:
+            return False
+        size = self.length
+        if not size:
+            # write() records the size of what it downloaded. Cache files from before it did may have been written
+            # non-atomically, and could be truncated, so check those against the remote size once.
+            sizefile = Path(str(self.filename) + '.size')
+            try:
+                size = int(sizefile.read_text())
+            except (FileNotFoundError, ValueError):
+                r = session.head(self.url, timeout=(5, 30))
+                if not r.ok or 'Content-Length' not in r.headers:
+                    raise BadHTTPStatus(self.url, self.offset, self.length, r.status_code, r.reason)
                 size = int(r.headers['Content-Length'])
-
-            fsize = self.filename.stat().st_size
-            if fsize == size:
-                #logger.debug('File is cached, reading from %s', self.filename)
-                with self.filename.open('rb') as f:
-                    contents = f.read()
-            else:
-                logger.debug('Cache file is %d bytes, remote file is %d bytes. Redownloading.', fsize, size)
-                self.filename.unlink()
-
-        if not contents:
-            contents = self.get()
-            if self.filename: # We should cache file.
-                self.write(contents)
-        if self.bypass_decompression: # special case for main index
-            return contents.decode()
-        return gzip.decompress(contents).decode()
-
-    def write(self, contents):
+                if st.st_size == size:
+                    sizefile.write_text(str(size))
+
+        fsize = st.st_size
+        if fsize == size:
+            return True
+        logger.debug('Cache file is %d bytes, remote file is %d bytes. Redownloading.', fsize, size)
+        self.filename.unlink()
+        return False
+
+    def iter_lines(self, chunksize=READ_BUFFER_SIZE, decode=True):
+        # The lines of the (decompressed) file, streamed, so that we never hold the entire file in memory.
+        # Lines are bytes if decode is not set.
+        if self.filename and not self.cached():
+            # Written in chunks, then read back, rather than holding all of it in memory between the two.
+            with self.get(stream=True) as r:
+                self.write(r.iter_content(WRITE_CHUNK_SIZE), record_size=not self.length) # Otherwise, cached() has that to check against.
+        if self.filename:
+            f = self.filename.open('rb')
+        else:
+            f = self.get(stream=True).raw
+        with f:
+            if not self.bypass_decompression:
+                f = GzipFile(fileobj=f)
+            f = io.BufferedReader(f, buffer_size=chunksize)
+            if decode:
+                f = io.TextIOWrapper(f, encoding='utf-8') # Not the locale's encoding.
+            newline = '\n' if decode else b'\n'
+            for line in f:
+                yield line.rstrip(newline)
+
+    def write(self, contents, record_size=False): # Either bytes, or an iterable of chunks.
+        # record_size is for files cached() will check, but that have no length to check against.
         if not self.filename:
-            raise RuntimeError('RemoteFile.write() called with no filename set: %s', url)
+            raise RuntimeError('RemoteFile.write() called with no filename set: %s', self.url)
         #logger.debug('Writing from %s to %s', self.url, self.filename)
-        if not self.filename.parents[0].exists():
-            logger.info('Recursively creating directory \'%s\'.', self.filename.parents[0])
-            self.filename.parents[0].mkdir(parents=True)
-        with self.filename.open('wb') as f:
-            f.write(contents)
-
-    def get(self):
+        self.filename.parents[0].mkdir(parents=True, exist_ok=True)
+        temp = Path(str(self.filename) + '.part') # So that a cache file is never seen half written.
+        if isinstance(contents, bytes):
+            temp.write_bytes(contents)
+        else:
+            with temp.open('wb') as f:
+                for chunk in contents:
+                    f.write(chunk)
+        if record_size:
+            # A failed transfer raises before we get here, so this is the remote size.
+            Path(str(self.filename) + '.size').write_text(str(temp.stat().st_size))
+        os.replace(temp, self.filename)
+
+    def get_range(self, start, end, stream=False):
+        # Byte range, inclusive at both ends.
+        return self.get({'Range': 'bytes=%d-%d' % (start, end)}, stream)
+
+    def get(self, headers=None, stream=False): # If stream is set, the response itself is returned rather than its contents.
         #logger.debug('Getting from %s', self.url)
-        time_diff = time.time() - self.requests['last']
-        if (time_diff < config.min_request_interval):
-            logger.debug('Request limit reached, sleeping for %f seconds.', config.min_request_interval - time_diff)
-            time.sleep(config.min_request_interval - time_diff)
+        if headers == None and type(self.offset) == int and self.length:
+            return self.get_range(self.offset, self.offset+self.length-1, stream)
+        with self.lock:
+            if time.monotonic() < self.requests['resume']:
+                logger.debug('Backing off, sleeping for %f seconds.', self.requests['resume'] - time.monotonic())
+                time.sleep(max(self.requests['resume'] - time.monotonic(), 0))
+            time_diff = time.monotonic() - self.requests['last']
+            if (time_diff < config.min_request_interval):
+                logger.debug('Request limit reached, sleeping for %f seconds.', config.min_request_interval - time_diff)
+                time.sleep(config.min_request_interval - time_diff)
+            now = time.monotonic()
+            while self.request_times and now - self.request_times[0] > config.max_requests_time:
+                self.request_times.popleft()
+            if len(self.request_times) >= config.max_requests_limit:
+                logger.debug('%d requests sent in the last %.1f seconds, sleeping for %f seconds.', len(self.request_times), config.max_requests_time, config.max_requests_time - (now - self.request_times[0]))
+                time.sleep(config.max_requests_time - (now - self.request_times[0]))
+            self.request_times.append(time.monotonic())
+            self.requests['last'] = time.monotonic()
 
         time_start = time.time()
-        headers = None # Should not need to be initialized/emptied, but do it anyway.
-        if type(self.offset) == int and self.length:
-            headers = {'Range': 'bytes=' + str(self.offset) + '-' + str(self.offset+self.length-1)}
-        self.requests['last'] = time.time()
-        monitor = Monitor.get('monitor')
+        monitor = self.monitor
         monitor.requests.inc()
         try:
-            r = requests.get(self.url, headers=headers)
+            # Stream, so we can bail out before the body is transferred if a range request was not honoured.
+            r = session.get(self.url, headers=headers, timeout=(5, 30), stream=True)
         except requests.RequestException as error:
             monitor.failed.inc()
             logger.error('Could not get %s - %s', self.url, error)
             raise
-        # Note that this excludes headers.
-        monitor.download_size.observe(len(r.content))
-        logger.debug('Downloaded %s in %f seconds. (%s/s)' % (human_readable(len(r.content)), time.time() - time_start, human_readable(len(r.content)/(time.time()-time_start))))
-        if not (r.status_code >= 200 and r.status_code < 300):
+        if headers and 'Range' in headers and r.status_code == 200:
+            # The server ignored the range and would send us the full file, which could be several GiB.
+            r.close()
+            monitor.failed.inc()
+            logger.error('Range request for %s (%s) was answered with the full file.', self.url, headers['Range'])
+            raise BadHTTPStatus(self.url, self.offset, self.length, r.status_code, 'Range not satisfied')
+        if not (r.status_code >= 200 and r.status_code < 300 or r.status_code == 304): # 304 only answers conditional requests.
             # This could imply a problem with parsing, raise it as such rather than simply bad status.
-            if r.status_code >= 400 and r.status_code < 500:
+            # 429 is rate limiting, however, and is backed off from like any server side error.
+            if r.status_code >= 400 and r.status_code < 500 and r.status_code != 429:
+                r.close() # The response is streamed, don't keep its connection from going back to the pool.
                 raise ParserError('HTTP response %d indicates a potential parsing issue. This should be investigated.', r.status_code)
             monitor.failed.inc()
-            sleep = config.min_request_interval * pow(1.5, self.requests['failed'])
-            if sleep > config.max_request_interval:
-                sleep = config.max_request_interval
-            self.requests['failed'] += 1
-            logger.error('Bad HTTP response %d %s for %s, sleeping for %.2f seconds (fail counter=%d).', r.status_code, r.reason, self.url, sleep, self.requests['failed'])
+            with self.lock: # Other download threads may fail at the same time.
+                sleep = config.min_request_interval * pow(1.5, self.requests['failed'])
+                if sleep > config.max_request_interval:
+                    sleep = config.max_request_interval
+                sleep = random.uniform(sleep / 2, sleep) # Jitter, so parallel downloads don't retry in lockstep.
+                retry_after = r.headers.get('Retry-After', '')
+                if retry_after.isdecimal() and int(retry_after) > sleep: # May also be an HTTP date, which we don't bother with.
+                    sleep = int(retry_after)
+                self.requests['failed'] += 1
+                failed = self.requests['failed']
+                # Hold back all other requests as well, not just this one.
+                self.requests['resume'] = max(self.requests['resume'], time.monotonic() + sleep)
+            logger.error('Bad HTTP response %d %s for %s, sleeping for %.2f seconds (fail counter=%d).', r.status_code, r.reason, self.url, sleep, failed)
+            r.close()
             time.sleep(sleep)
             raise BadHTTPStatus(self.url, self.offset, self.length, r.status_code, r.reason)
 
-        self.requests['failed'] = 0
+        with self.lock:
+            self.requests['failed'] = 0
+        if stream:
+            return r
+        # Note that this excludes headers.
+        size = len(r.content)
+        elapsed = time.time() - time_start
+        monitor.download_size.observe(size)
+        logger.debug('Downloaded %s in %f seconds. (%s/s)', human_readable(size), elapsed, human_readable(size/elapsed) if elapsed > 0 else 'N/A')
         return r.content
 
 class RetryQueue:
     # Overall, very hack quality. But it will do.
-    queue = [] # [RemoteFile(file1), RemoteFile(file2), ...]
+    # The retryqueue file is a log. Added items are appended to it, removed ones get a DEL line, and it is rewritten
+    # with only the current queue on load, on exit, and whenever most of it has gone stale.
+    queue = collections.deque() # [RemoteFile(file1), RemoteFile(file2), ...]
+    lock = threading.RLock()
+    processing = [] # Taken off the queue, but not yet downloaded.
+    logged = 0 # Lines in the retryqueue file.
 
     def load(self):
         if Path('retryqueue').exists():
+            items = {} # By filename, in queue order.
             with open('retryqueue', 'r') as f:
                 for line in f:
+                    if line.startswith('DEL\t'):
+                        items.pop(line[4:].rstrip('\n'), None)
+                        continue
                     url,filename,offset,length,domain,archiveID,attempts = line.split('\t')
-                    self.add(RemoteFile(url, Path(filename), int(offset), int(length), domain, archiveID), True)
-                    self.queue[len(self.queue)-1].attempts = int(attempts) # Not the prettiest way of doing it, but this one case
-                                                                           # does not warrant __init__ inclusion.
-                logger.info('Loaded retry queue with %d items.', len(self.queue))
+                    item = RemoteFile(url, Path(filename), int(offset), int(length), domain, archiveID)
+                    item.attempts = int(attempts)
+                    items[filename] = item
+            with self.lock:
+                self.queue.extend(items.values())
+                self.save()
+            logger.info('Loaded retry queue with %d items.', len(self.queue))
 
     def process(self):
         if len(self.queue) == 0:
             return
-        item = self.queue[0]
-        domain = get_domain(item.domain)
-        if not domain:
-            raise RuntimeError('Unknown domain in retry queue: %s %s %s', item.url, item.filename, item.domain)
-        domain.updateHistory(item.archiveID, 'failed', domain.history[item.archiveID]['failed'] - 1)
-        self.queue.pop(0).download()
-        self.save()
-
-    def add(self, item, no_history=None):
-        if not no_history:
+        # Downloads are bound by network latency rather than anything else, so fetch a batch of them in parallel.
+        # Failed downloads will add themselves back to the queue.
+        with self.lock:
+            batch = [self.queue.popleft() for i in range(min(config.max_requests_limit, len(self.queue)))]
+            RetryQueue.processing = batch
+        for item in batch:
             domain = get_domain(item.domain)
             if not domain:
-                logger.warning('\'%s\' is no longer in domain list, removing item from retry queue: %s -> %s', item.domain, item.url, item.filename)
-                return # This domain is no longer on our list.
-            # A slightly convoluted construction.
+                raise RuntimeError('Unknown domain in retry queue: %s %s %s', item.url, item.filename, item.domain)
+            domain.updateHistory(item.archiveID, 'failed', domain.history[item.archiveID]['failed'] - 1)
+        results = list(get_download_pool().map(RemoteFile.download, batch))
+        # Only logged as removed once done, so nothing is lost if we're stopped halfway. Those that failed again are
+        # still in the log, under the same filename.
+        with self.lock:
+            self.log(['DEL\t' + str(item.filename) + '\n' for item,result in zip(batch, results) if result != False])
+            RetryQueue.processing = []
+
+    def add(self, item):
+        domain = get_domain(item.domain)
+        if not domain:
+            logger.warning('\'%s\' is no longer in domain list, removing item from retry queue: %s -> %s', item.domain, item.url, item.filename)
+            return # This domain is no longer on our list.
+        # A slightly convoluted construction.
+        with domain.lock:
             domain.updateHistory(item.archiveID, 'failed', domain.history[item.archiveID]['failed'] + 1)
-        self.queue.append(item)
-        self.save()
-        
+        with self.lock:
+            self.queue.append(item)
+            self.log([self.entry(item)])
+
+    def entry(self, item):
+        return item.url + '\t' + str(item.filename) + '\t' + str(item.offset) + '\t' + str(item.length) + '\t' + item.domain + '\t' + item.archiveID + '\t' + str(item.attempts) + '\n'
+
+    def log(self, lines):
+        if not lines:
+            return
+        with self.lock:
+            with open('retryqueue', 'a') as f:
+                f.writelines(lines)
+            RetryQueue.logged += len(lines)
+            if RetryQueue.logged > 2*len(self.queue) + 100:
+                self.save()
+
     def save(self):
-        with open('retryqueue', 'w') as f:
-            for item in self.queue:
-                f.write(item.url + '\t' + str(item.filename) + '\t' + str(item.offset) + '\t' + str(item.length) + '\t' + item.domain + '\t' + item.archiveID + '\t' + str(item.attempts) + '\n')
-            f.close()
+        with self.lock:
+            items = self.processing + list(self.queue)
+            with open('retryqueue.tmp', 'w') as f:
+                f.write(''.join(self.entry(item) for item in items))
+            os.replace('retryqueue.tmp', 'retryqueue')
+            RetryQueue.logged = len(items)
+
+    def shutdown(self):
+        get_download_pool().shutdown(wait=True)
 
 class Domain:
-    domains = []
+    __slots__ = ('domain', 'searchString', 'searchPrefixes', 'history', 'historyDirty', 'historySaved')
+    domains = {} # By name, main() keeps them in configured order.
+    lock = threading.RLock() # History may be updated from several download threads at once.
     
     def __init__(self, domain): # TODO: Check that it's not a duplicate.
         logger.debug('New domain: %s', domain)
@@ -530,23 +878,29 @@ class Domain:
             raise ValueError('Domains are expected to contain dots (.), read \'%s\'.' % domain)
 
         self.domain = domain
-        self.searchString = ''
         domainParts = domain.split('.')
-        for i in range(len(domainParts),0,-1):
-            if not domainParts[i-1].replace('-', '').isalnum(): # Not the prettiest or most strictly accurate way of doing this,
-                                                                # but will be sufficient for our purposes.
+        for part in domainParts:
+            if not part.replace('-', '').isalnum(): # Not the prettiest or most strictly accurate way of doing this,
+                                                    # but will be sufficient for our purposes.
                 raise ValueError('Domains can only contain alphanumeric characters, hyphens, and dots, read \'%s\'.' % domain)
-            self.searchString += domainParts[i-1]
-            if i > 1:
-                self.searchString += ','
+        self.searchString = ','.join(reversed(domainParts))
+        self.searchPrefixes = (self.searchString + ')', self.searchString + ',') # What matching lines start with, see is_match().
+        self.historyDirty = False
+        self.historySaved = float('-inf') # Monotonic time.
         self.loadHistory()
-        Domain.domains.append(self)
+        Domain.domains[domain] = self
 
     def __repr__(self):
         return self.domain
 
-    def __eq__(self, other):
-        return str(self) == str(other)
+    def __eq__(self, other): # Also equal to its name.
+        return self.domain == (other.domain if isinstance(other, Domain) else other)
+
+    def __hash__(self):
+        return hash(self.domain)
+
+    def pending(self, archiveID): # Whether there is anything left to do for archiveID.
+        return not archiveID in self.history or self.history[archiveID]['completed'] < self.history[archiveID]['results']
 
     def loadHistory(self):
         logger.debug('Loading history for %s', self.domain)
@@ -554,25 +908,41 @@ class Domain:
         p = Path('history/' + self.domain)
 
         if path_is_safe(p, self) and p.exists():
-            with p.open('r') as f:
-                self.history = json.load(f)
+            with p.open('rb') as f:
+                self.history = json_loads(f.read())
                 logger.debug('Loaded search history for %s', self.domain)
         else:
             self.history = {}
 
     def updateHistory(self, archiveID, key, history):
         #logger.debug('Updating history for %s/%s (%s: %s)', self.domain, archiveID, key, str(history))
-        if not archiveID in self.history:
-            self.history[archiveID] = {'completed': 0, 'failed': 0, 'results': 0}
-        self.history[archiveID][key] = history
-        p = Path('history', self.domain)
-        if path_is_safe(p, self):
-            if not p.parents[0].exists():
-                p.parents[0].mkdir()
-            with Path('tempfile').open('w') as f:
-                json.dump(self.history, f)
-                # No log message, we might do this often.
-            Path('tempfile').rename(p)
+        with self.lock:
+            if not archiveID in self.history:
+                self.history[archiveID] = {'completed': 0, 'failed': 0, 'results': 0}
+            self.history[archiveID][key] = history
+            self.historyDirty = True
+            # This is called for every download and retry, so only write it out once a second at most.
+            # Whatever is left is saved by saveAll().
+            if time.monotonic() - self.historySaved >= 1:
+                self.saveHistory()
+
+    def saveHistory(self):
+        with self.lock:
+            if not self.historyDirty:
+                return
+            p = Path('history', self.domain)
+            if path_is_safe(p, self):
+                p.parents[0].mkdir(exist_ok=True)
+                with Path('tempfile').open('wb') as f:
+                    f.write(json_dumps(self.history))
+                    # No log message, we might do this often.
+                os.replace('tempfile', p)
+            self.historyDirty = False
+            self.historySaved = time.monotonic()
+
+    def saveAll():
+        for domain in Domain.domains.values():
+            domain.saveHistory()
 
 class Search:
     def __init__(self, domain, archive):
@@ -595,65 +965,71 @@ class Search:
         logger.info('Processing %s in %s.', self.domain.domain, self.archive.archiveID)
 
         self.clusters = []
-        index = []
-        if not self.archive.clusterIndex: # Implies indexPathsURI is also empty
-            self.archive.updatePaths()
-        for line in self.archive.clusterIndex.read().splitlines():
-            searchable_string,rest = line.split(' ')
-            timestamp,filename,offset,length,cluster = rest.split('\t')
-            index.append(
-                (searchable_string, # 0
-                 int(timestamp),    # 1
-                 filename,          # 2
-                 int(offset),       # 3
-                 int(length),       # 4
-                 int(cluster)       # 5
-                ))
+        index = get_cluster_index(self.archive)
+        logger.debug('Cluster index cache: %s', get_cluster_index.cache_info())
 
         # This search format should mean we're always left of anything matching our search string.
-        position = bisect.bisect_left(index, (self.domain.searchString + ')', 0, '', 0, 0, 0))
-        logger.debug('(cluster index) Potential match at line %d out of %d. (Between %s and %s)', position+1, len(index), (position <= 0 and '(index out of range)' or index[position-1][0]), index[position][0])
+        position = index.bisect(self.domain.searchString + ')')
+        logger.debug('(cluster index) Potential match at line %d out of %d. (Between %s and %s)', position+1, len(index), (position <= 0 and '(index out of range)' or index.keys[position-1]), (position >= len(index) and '(index out of range)' or index.keys[position]))
         # We may (and likely will) have matches in the index cluster prior to our match.
-        self.clusters.append(index[position-1])
+        cluster = index.find(self.domain.searchString + ')')
+        if cluster:
+            self.clusters.append(cluster)
         while position < len(index):
-            if is_match(index[position][0], self.domain.searchString):
+            if index.keys[position].startswith(self.domain.searchPrefixes):
                 self.clusters.append(index[position])
                 position += 1
             else:
                 break
 
+    def readClusters(self, clusters): # The json data of the lines in clusters matching our search string, as bytes.
+        # clusters are adjacent in the same file, so they are fetched as one range. Each cluster is a gzip member of its
+        # own, which GzipFile reads back to back.
+        first,last = clusters[0],clusters[-1]
+        if config.cache_index_clusters:
+            cacheFileName = str(config.cache_dir) + '/' + self.archive.archiveID + '/' + first[2] + '-' + str(first[5])
+            if len(clusters) > 1:
+                cacheFileName += '-' + str(last[5])
+        else:
+            cacheFileName = None
+        indexFile = RemoteFile(
+            config.archive_host + '/' + self.archive.indexPathsURI + first[2],
+            cacheFileName,
+            first[3],
+            last[3] + last[4] - first[3])
+        searchString = self.domain.searchString.encode()
+        searchPrefixes = tuple(prefix.encode() for prefix in self.domain.searchPrefixes)
+        results = []
+        # Lines are sorted, and start with the searchable string followed by a space, which sorts before anything that
+        # could follow it in a match. Stream them, so we can stop reading at the first line past our matches.
+        for line in indexFile.iter_lines(decode=False): # Only matching lines need decoding, and json_loads takes bytes.
+            if line < searchString: # Only the first cluster should have lines before our matches.
+                continue
+            if not line.startswith(searchPrefixes):
+                break
+            # Only the json data will be interesting from here on.
+            results.append(line.split(b' ', 2)[2])
+        logger.debug('Found %d matches in %d cluster(s) of %s.', len(results), len(clusters), first[2])
+        return results
+
     def findArchives(self): # TODO: Not happy with variable names here. Need to revisit and rename.
         logger.debug('Searching %s clusters for %s', self.archive.archiveID, self.domain.domain)
 
         self.archives = []
+        # Matches for a popular domain span many clusters, which mostly follow each other in the same file. Fetching
+        # those as one range saves a request, and its share of the rate limit, for each.
+        runs = []
         for cluster in self.clusters:
-            index = []
-            if config.cache_index_clusters:
-                cacheFileName = str(config.cache_dir) + '/' + self.archive.archiveID + '/' + cluster[2] + '-' + str(cluster[5])
-            else:
-                cacheFileName = None
-            indexFile = RemoteFile(
-                config.archive_host + '/' + self.archive.indexPathsURI + cluster[2],
-                cacheFileName,
-                cluster[3],
-                cluster[4])
-            for line in indexFile.read().splitlines():
-                searchable_string,timestamp,json = line.split(' ', 2)
-                index.append((searchable_string, int(timestamp), json))
-
-            if cluster is self.clusters[0]:
-                position = bisect.bisect_left(index, (self.domain.searchString, 0, ''))
+            previous = runs[-1][-1] if runs else None
+            if previous and len(runs[-1]) < MAX_CLUSTERS_PER_REQUEST and cluster[2] == previous[2] and cluster[3] == previous[3] + previous[4]:
+                runs[-1].append(cluster)
             else:
-                position = 0
-            logger.debug('Index insertion point at line %d out of %d. (%s)', position+1, len(index), index[position][0])            
-            # Unlike the cluster index, there should be no earlier result than position.
-            while position < len(index):
-                if is_match(index[position][0], self.domain.searchString):
-                    # Only the json data will be interesting from here on.
-                    self.archives.append(index[position][2])
-                    position += 1
-                else:
-                    break
+                runs.append([cluster])
+        # Runs are fetched and searched in parallel, in batches so we don't hold too many at once, but kept in order.
+        for start in range(0, len(runs), config.max_requests_limit):
+            batch = runs[start:start+config.max_requests_limit]
+            for results in get_download_pool().map(self.readClusters, batch):
+                self.archives.extend(results)
         if len(self.archives) == 0:
             self.domain.updateHistory(self.archive.archiveID, 'completed', 0)
             Monitor.get('monitor').UpdateStatus(current_progress='N/A')
@@ -666,14 +1042,15 @@ class Search:
             position = 0
         elif type(self.domain.history[self.archive.archiveID]['completed']) == int:
             position = self.domain.history[self.archive.archiveID]['completed']
-
-        fileInfo = json.loads(self.archives[position])
-
-        Monitor.get('monitor').UpdateStatus(current_progress='%d/%d (%d%%)' % (position + 1, self.domain.history[self.archive.archiveID]['results'], (100*(position + 1) / self.domain.history[self.archive.archiveID]['results'])))
-        if int(fileInfo['length']) > config.max_file_size:
-            logger.warning('Skipping download of %s as file exceeds size limit at %s bytes.', fileInfo['filename'], fileInfo['length'])
-            self.domain.updateHistory(self.archive.archiveID, 'completed', position+1)
-        else:
+        # Downloads are bound by network latency, so fetch a batch of results in parallel.
+        end = min(position + config.max_requests_limit, len(self.archives))
+
+        Monitor.get('monitor').UpdateStatus(current_progress='%d/%d (%d%%)' % (end, self.domain.history[self.archive.archiveID]['results'], (100*end / self.domain.history[self.archive.archiveID]['results'])))
+        files = []
+        for fileInfo in map(json_loads, self.archives[position:end]):
+            if int(fileInfo['length']) > config.max_file_size:
+                logger.warning('Skipping download of %s as file exceeds size limit at %s bytes.', fileInfo['filename'], fileInfo['length'])
+                continue
             filerange = '-' + fileInfo['offset'] + '-' + str(int(fileInfo['offset'])+int(fileInfo['length'])-1)
 
             filename = str(config.tempdir) + '/'
@@ -687,14 +1064,13 @@ class Search:
                 raise RuntimeError('Unknown file ending for %s', fileInfo['filename'])
 
             url = config.archive_host + '/' + fileInfo['filename']
-            rf = RemoteFile(url, filename, int(fileInfo['offset']), int(fileInfo['length']), self.domain.domain, self.archive.archiveID)
+            files.append(RemoteFile(url, filename, int(fileInfo['offset']), int(fileInfo['length']), self.domain.domain, self.archive.archiveID))
             #logger.debug('Downloading from %s (range %i-%i) to %s', url, int(fileInfo['offset']), int(fileInfo['offset'])+int(fileInfo['length'])-1, filename)
-            try:
-                rf.download()
-            except (requests.RequestException, BadHTTPStatus):
-                raise
-            finally:
-                self.domain.updateHistory(self.archive.archiveID, 'completed', position+1)
+        try:
+            # Failed downloads are added to the retry queue by RemoteFile.download().
+            list(get_download_pool().map(RemoteFile.download, files))
+        finally:
+            self.domain.updateHistory(self.archive.archiveID, 'completed', end)
 
 #
 
@@ -706,27 +1082,36 @@ def main():
     archives = ArchiveList()
     domains = []
     domains_last_modified = 0
+    domains_last_checked = float('-inf') # Monotonic time.
     finished_message = False
     monitor = Monitor.get('monitor')
     monitor.state.state('idle')
     hasProcessed = False
     current_search = None
 
+    atexit.register(Domain.saveAll) # Registered first, so it runs after downloads in progress have finished.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # Otherwise, atexit handlers don't run when we're stopped.
+
     logger.debug('Loading retry queue.')
     retryqueue = RetryQueue()
     retryqueue.load()
+    atexit.register(retryqueue.save)
+    atexit.register(retryqueue.shutdown) # Runs before the save, so that downloads in progress can finish first.
 
     start_http_server(config.prometheus_port)
 
     if config.indexing_method == INDEX_AUTO:
-        last_index_hack = 0 # Ensure we do a pass as soon as possible.
+        last_index_hack = float('-inf') # Ensure we do a pass as soon as possible.
         unknown_status_files = FileList.get('unknown_status_files')
         for archive in config.download_dir.iterdir():
             unknown_status_files.add(archive.name)
         logger.info('Cached %d previously downloaded files for index comparison.' % len(unknown_status_files))
 
     while True:
-        if Path(config.domain_list_file).stat().st_mtime > domains_last_modified:
+        if time.monotonic() - domains_last_checked >= 10: # The domain list rarely changes, no need to stat it on every pass.
+            domains_last_checked = time.monotonic()
+            domains_modified = Path(config.domain_list_file).stat().st_mtime
+        if domains_modified > domains_last_modified:
             if domains_last_modified == 0:
                 logger.info('Reading domain list.')
             else:
@@ -738,8 +1123,10 @@ def main():
             # to reload any history we have saved.
             # If I get spare time, I may rewrite this.
 
+            Domain.saveAll()
             domains = []
-            Domain.domains = [] # This bit is ugly.
+            Domain.domains = {} # This bit is ugly.
+            current_search = None # Would hold on to the old Domain.
 
             with config.domain_list_file.open('r') as f:
                 line_number = 0
@@ -748,29 +1135,32 @@ def main():
                     if len(line) == 0:
                         logger.debug('Empty line in %s, skipping.', config.domain_list_file)
                         break
-                    if line in domains:
+                    if line in Domain.domains:
                         logger.warning('Duplicate domain: %s (line %d in %s)', line, line_number, str(config.domain_list_file))
                     else:
                         domains.append(Domain(line))
 
-            domains_last_modified = Path(config.domain_list_file).stat().st_mtime
+            domains_last_modified = domains_modified # As of before reading it, so changes made meanwhile are picked up.
 
         archives.update()
         retryqueue.process()
 
-        if config.indexing_method == INDEX_AUTO and time.time() - last_index_hack > 600: # Once every 10 minutes should be good.
+        if config.indexing_method == INDEX_AUTO and time.monotonic() - last_index_hack > 600: # Once every 10 minutes should be good.
             if len(unknown_status_files) > 0: unknown_status_files.check_and_hack()
-            last_index_hack = time.time()
+            last_index_hack = time.monotonic()
         
         archive = None
         domain = None
+        if current_search and current_search.domain.pending(current_search.archive.archiveID):
+            # Carry on with the current search, rather than scanning every domain and archive from the start again.
+            domain = current_search.domain
+            archive = current_search.archive
         for d in domains:
             # Not the most elegant solution, but we'll want a double break somehow.
             if domain:
                 break
             for _,a in archives:
-                # 1 will equal True, so instead, we will have to do a type comparison.
-                if not a.archiveID in d.history or d.history[a.archiveID]['completed'] < d.history[a.archiveID]['results']:
+                if d.pending(a.archiveID):
                     domain = d
                     archive = a
                     monitor.UpdateStatus(current_domain='%s (%d/%d)' % (str(domain), domains.index(domain)+1, len(domains)), current_archive='%s (%d/%d)' % (archive.archiveID, archive.order, len(archives.archives)))
@@ -778,10 +1168,11 @@ def main():
 
         if not domain:
             current_search = None # Make sure we're not sitting on memory we don't need.
+            Domain.saveAll()
             monitor.state.state('idle')
             if not finished_message:
                 monitor.UpdateStatus(current_domain='N/A', current_archive='N/A', current_progress='N/A')
-                logger.info('All searches currently finished, next archive list update check in %.2f seconds.', 86400 - (time.time() - archives.lastUpdate))
+                logger.info('All searches currently finished, next archive list update check in %.2f seconds.', 86400 - (time.monotonic() - archives.lastUpdate))
                 finished_message = True
             if hasProcessed:
                 mailer.info('All configured domains have been processed in all current archives.%s' % ('\n%d items remain in retry queue.' % len(retryqueue.queue) if len(retryqueue.queue) > 0 else ''))
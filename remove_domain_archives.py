@@ -27,14 +27,11 @@ def main():
         sys.exit()
 
     domainParts = sys.argv[1].split('.')
-    searchString = ''
-    for i in range(len(domainParts),0,-1):
-        if not domainParts[i-1].replace('-', '').isalnum(): # Not the prettiest or most strictly accurate way of doing this,
-                                                            # but will be sufficient for our purposes.
+    for part in domainParts:
+        if not part.replace('-', '').isalnum(): # Not the prettiest or most strictly accurate way of doing this,
+                                                # but will be sufficient for our purposes.
             raise ValueError('Domains can only contain alphanumeric characters, hyphens, and dots, read \'%s\'.' % sys.argv[1])
-        searchString += domainParts[i-1]
-        if i > 1:
-            searchString += ','
+    searchString = ','.join(reversed(domainParts))
 
     position = bisect.bisect_left(index, (searchString, 0, ''))
     results = 0